@@ -1,17 +1,30 @@
 # Script for training the Random Forest Classifier
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier, HistGradientBoostingClassifier
 from sklearn.metrics import accuracy_score, confusion_matrix, classification_report
 from sklearn.model_selection import train_test_split
 import numpy as np
+import pandas as pd
 from xml.etree import ElementTree as ET
 from sklearn.tree import export_graphviz
 from graphviz import Source
 from sklearn.preprocessing import LabelEncoder
 import matplotlib.pyplot as plt
-import pickle
-from skimage.transform import resize
-import cv2
+import joblib
 import rasterio
+from numba import njit
+import multiprocessing
+import os
+import argparse
+from functools import lru_cache
+
+# Larger GDAL block cache so decoded blocks are reused between reads
+os.environ['GDAL_CACHEMAX'] = '1024'
+
+# Images with more pixels than this are read block by block
+LARGE_IMAGE_PIXELS = 1024 * 1024
+
+# Feature matrix memmap opened by each preprocessing worker
+_features = None
 
 def get_training_data(path_to_data='Inputs/training_data_attempt_1'):
     """
@@ -25,69 +38,108 @@ def get_training_data(path_to_data='Inputs/training_data_attempt_1'):
             label_path (list): list of xml file paths
     """
     mapfile = path_to_data + '/map.txt'
-    image_path = []
-    label_path = []
 
-    with open(mapfile) as file:
-        for line in file.readlines():
-            element = line.strip('\n')
-            element = element.replace('\\', '/')
-            element = element.split()
-            image_path.append(path_to_data + '/' + element[0])
-            label_path.append(path_to_data + '/' + element[1])
+    df = pd.read_csv(mapfile, sep=r'\s+', header=None, usecols=[0, 1], names=['img', 'xml'])
+    df['img'] = df['img'].str.replace('\\', '/', regex=False)
+    df['xml'] = df['xml'].str.replace('\\', '/', regex=False)
+
+    image_path = (path_to_data + '/' + df['img']).tolist()
+    label_path = (path_to_data + '/' + df['xml']).tolist()
 
     return image_path, label_path
 
-def preprocess_training_data(image_path, label_path):
+@njit(cache=True, fastmath=True)
+def build_rgb(red, green, blue, alpha, out):
     """
-    Function to extract image pixel values and labels and store them in a list
+    Function to mask the bands with the alpha band and stack them into an rgb image in one pass
         Parameters:
-            image_path (list): list of image file paths
-            label_path (list): list of xml file paths
+            red (array): values from red band of image
+            green (array): values from green band of image
+            blue (array): values from blue band of image
+            alpha (array): values from alpha band of image
+            out (array): preallocated rgb array the masked bands are written to
+    """
+    for i in range(red.shape[0]):
+        for j in range(red.shape[1]):
+            m = alpha[i, j] != 0
+            out[i, j, 0] = red[i, j] * m
+            out[i, j, 1] = green[i, j] * m
+            out[i, j, 2] = blue[i, j] * m
+
+def _process_one(image):
+    """
+    Function to open an image once and extract the original, flipped and rotated pixel values
+        Parameters:
+            image (string): file path to image
 
         Returns:
-            images (list): list of image pixel values for each image
-            labels (list): list of labels for each image
+            features (array): (3, n_features) array holding the flattened pixel values of the image,
+                              the image flipped vertically and the image rotated 90 degrees anticlockwise
     """
-    images = []
-    labels = []
-    for image in image_path:
-        nX, nY, red, green, blue, alpha = preprocess_image(image)
+    nX, nY, red, green, blue, alpha = preprocess_image(image)
+
+    # One C-contiguous buffer for all three versions, each row is written in row-major order
+    features = np.empty([3, nY, nX, 3], dtype=np.float32)
+    build_rgb(red, green, blue, alpha, features[0])
+
+    # Flip image vertically
+    features[1] = features[0, ::-1]
+
+    # Rotate image by 90 degrees anticlockwise (an index permutation, no interpolation)
+    features[2] = np.rot90(features[0], k=1)
+
+    return features.reshape(3, -1)
 
-        rgb = np.zeros([nX, nY, 3])
-        rgb[:, :, 0] = red
-        rgb[:, :, 1] = green
-        rgb[:, :, 2] = blue
+def _init_worker(features_path, shape):
+    """
+    Function run once in each worker process to open the shared feature matrix
+        Parameters:
+            features_path (string): file path to the feature memmap
+            shape (tuple): shape of the feature matrix
+    """
+    global _features
+    _features = np.memmap(features_path, mode='r+', dtype=np.float32, shape=shape)
 
-        #plt.imshow(rgb)
-        #plt.show()
-        
+def _write_one(task):
+    """
+    Function to write the original, flipped and rotated pixel values of one image into the shared feature matrix
+        Parameters:
+            task (tuple): index and file path of the image
 
-        red_masked = red[alpha != 0]
-        green_masked = green[alpha != 0]
-        blue_masked = blue[alpha != 0]
-    
-        red_masked = resize(red_masked, (nX, nY))
-        green_masked = resize(green_masked, (nX, nY))
-        blue_masked = resize(blue_masked, (nX, nY))
+        Returns:
+            i (int): index of the image
+    """
+    i, image = task
+    N = _features.shape[0] // 3
 
-        rgb = np.zeros([nX, nY, 3])
-        rgb[:, :, 0] = red_masked
-        rgb[:, :, 1] = green_masked
-        rgb[:, :, 2] = blue_masked
+    # Rows i, N + i and 2N + i hold the original, flipped and rotated image
+    _features[i::N] = _process_one(image)
+    return i
 
-        #plt.imshow(rgb)
-        #plt.show()
+def load_and_augment(image_path, features_path):
+    """
+    Function to read each image once and store the original and augmented versions of the image
+    in a feature matrix on disk. The images are processed in parallel, one worker process per core,
+    and each worker writes its rows straight into the memmap rather than sending them back.
+        Parameters:
+            image_path (list): list of image file paths
+            features_path (string): file path to the feature memmap
 
-        flattened_image = rgb.flatten()
-        images.append(flattened_image)
+        Returns:
+            images (memmap): read-only (3 * len(image_path), n_features) feature matrix, originals
+                             then flipped then rotated images
+    """
+    shape = (3 * len(image_path), 50 * 50 * 3)
+    np.memmap(features_path, mode='w+', dtype=np.float32, shape=shape).flush()
 
-    for label in label_path:
-        classification = extract_classification(label)
-        labels.append(classification)
+    ncpu = os.cpu_count()
+    chunksize = max(1, len(image_path) // (4 * ncpu))
 
-    return images, labels
+    with multiprocessing.Pool(ncpu, initializer=_init_worker, initargs=(features_path, shape)) as pool:
+        for _ in pool.imap_unordered(_write_one, enumerate(image_path), chunksize=chunksize):
+            pass
 
+    return np.memmap(features_path, mode='r', dtype=np.float32, shape=shape)
 
 def preprocess_image(image):
     """
@@ -98,22 +150,35 @@ def preprocess_image(image):
         returns:
             nX (int): pixel width of image 
             nY (int): pixel height of image
-            red (array): values from red band of image
-            green (array): values from green band of image
-            blue (array): values from blue band of image
-            alpha (array): values from alpha band of image
+            red (array): values from red band of image, scaled to [0, 1]
+            green (array): values from green band of image, scaled to [0, 1]
+            blue (array): values from blue band of image, scaled to [0, 1]
+            alpha (array): values from alpha band of image, scaled to [0, 1]
     """
     with rasterio.open(image) as dataset:
         nX = dataset.width
         nY = dataset.height
 
-        red = dataset.read(1)
-        green = dataset.read(2)
-        blue = dataset.read(3)
-        alpha = dataset.read(4)
+        if nX * nY > LARGE_IMAGE_PIXELS:
+            # Read large scenes one GDAL block at a time into a preallocated array
+            bands = np.empty((dataset.count, nY, nX), dtype=np.float32)
+            for _, window in dataset.block_windows(1):
+                rows, cols = window.toslices()
+                bands[:, rows, cols] = dataset.read(window=window, out_dtype='float32')
+        else:
+            # Read all four bands in a single call
+            bands = dataset.read(out_dtype='float32')
+        dtype = np.dtype(dataset.dtypes[0])
+
+    # Scale integer band values to [0, 1]
+    if np.issubdtype(dtype, np.integer):
+        bands /= np.iinfo(dtype).max
+
+    red, green, blue, alpha = bands
 
     return nX, nY, red, green, blue, alpha
 
+@lru_cache(maxsize=None)
 def extract_classification(label):
     """
     Function to open xml file and extract the class an image belongs to
@@ -130,217 +195,128 @@ def extract_classification(label):
     return classification
 
 
-def augment_flip(image_path, label_path):
-    """
-    Function to extract an augmented version of the training data. The data is flipped vertically.
-        Parameters:
-            image_path (list): list of image file paths
-            label_path (list): list of xml file paths
-        Returns:
-            images (list): list of image pixel values for each image
-            labels (list): list of labels for each image
-    """
-    images = []
-    labels = []
-    for image in image_path:
-        nX, nY, red, green, blue, alpha = preprocess_image(image)
-        
-        flipped_red = np.flipud(red)
-        flipped_green = np.flipud(green)
-        flipped_blue = np.flipud(blue)
-        flipped_alpha = np.flipud(alpha)
-
-        red_masked = flipped_red[flipped_alpha != 0]
-        green_masked = flipped_green[flipped_alpha != 0]
-        blue_masked = flipped_blue[flipped_alpha != 0]
-    
-        red_masked = resize(red_masked, (nX, nY))
-        green_masked = resize(green_masked, (nX, nY))
-        blue_masked = resize(blue_masked, (nX, nY))
-
-        
-        rgb = np.zeros([nX, nY, 3])
-        
-        rgb[:, :, 0] = red_masked
-        rgb[:, :, 1] = green_masked
-        rgb[:, :, 2] = blue_masked
-
-        #plt.imshow(rgb)
-        #plt.show()
-
-        flattened_image = rgb.flatten()
-        images.append(flattened_image)
-
-    for label in label_path:
-        classification = extract_classification(label)
-        labels.append(classification)
-
-    return images, labels
-
-def augment_flip_rotate_90(image_path, label_path):
-    """
-    Function to extract an augmented version of the training data. The data is rotated 90 degrees anticlockwise.
-        Parameters:
-            image_path (list): list of image file paths
-            label_path (list): list of xml file paths
-        Returns:
-            images (list): list of image pixel values for each image
-            labels (list): list of labels for each image
-    """
-    images = []
-    labels = []
-    for image in image_path:
-        nX, nY, red, green, blue, alpha = preprocess_image(image)
-        
-        red_masked = red[alpha != 0]
-        green_masked = green[alpha != 0]
-        blue_masked = blue[alpha != 0]
-    
-        red_masked = resize(red_masked, (nX, nY))
-        green_masked = resize(green_masked, (nX, nY))
-        blue_masked = resize(blue_masked, (nX, nY))
-
-        rgb_flip = np.zeros([nX, nY, 3])
-        
-        rgb_flip[:, :, 0] = red_masked
-        rgb_flip[:, :, 1] = green_masked
-        rgb_flip[:, :, 2] = blue_masked
-
-        # Rotate image by 90 degrees
-        rotation_angle = 90
-        rotation_matrix = cv2.getRotationMatrix2D((nX/2, nY/2), rotation_angle, 1.0)
-        rotated_rgb = cv2.warpAffine(rgb_flip, rotation_matrix, (nY, nX))
-
-        #plt.imshow(rotated_rgb)
-        #plt.show()
-
-        flattened_image = rotated_rgb.flatten()
-        images.append(flattened_image)
-
-
-    for label in label_path:
-        classification = extract_classification(label)
-        labels.append(classification)
-
-    
-    return images, labels
-
-image_path, label_path = get_training_data()
-images, labels, = preprocess_training_data(image_path, label_path)
-augmented_images, augmented_labels = augment_flip(image_path, label_path)
-augmented_images2, augmented_labels2 = augment_flip_rotate_90(image_path, label_path)
-
-combined_images = []
-combined_labels = []
-
-# Add original images and labels
-combined_images.extend(images)
-combined_labels.extend(labels)
-
-# Add augmented images and labels
-combined_images.extend(augmented_images)
-combined_labels.extend(augmented_labels)
-
-# Add augmented images and labels
-combined_images.extend(augmented_images2)
-combined_labels.extend(augmented_labels2)
-
-images = np.array(combined_images)
-labels = np.array(combined_labels)
-
-# Visualize 5 sample images
-num_samples = 5
-fig, axes = plt.subplots(1, num_samples, figsize=(15, 5))
-
-for i in range(num_samples):
-    image_show = images[i].reshape(50, 50, 3)
-    label = labels[i]
-    
-    # Convert image from BGR to RGB
-    image_show_rgb = image_show[..., [0, 1, 2]]
-    
-    # Normalize pixel values to [0, 1] for 16-bit images
-    image_show_rgb = image_show_rgb.astype(float)
-    
-    # Clip pixel values to [0, 1]
-    image_show_rgb = np.clip(image_show_rgb, 0, 1)
-    
-    # Display the image
-    axes[i].imshow(image_show_rgb)  # Display RGB image
-    axes[i].set_title(f"Label: {label}")
-    axes[i].axis('off')
-
-plt.tight_layout()
-plt.show()
-
-print(images.shape)
-print(labels.shape)
-
-# Split the data into training and testing sets
-X_train, X_test, y_train, y_test = train_test_split(images, labels, test_size=0.2, random_state=60)
-
-# Encode the labels
-label_encoder = LabelEncoder()
-y_train_encoded = label_encoder.fit_transform(y_train)
-y_test_encoded = label_encoder.transform(y_test)
-
-# Initiates the Random Forest classifier
-model = RandomForestClassifier()
-
-# Train the classifier
-model = model.fit(X_train, y_train)
-
-tree_estimator = model.estimators_[0]
-
-# Predict the labels for the test set
-y_pred = model.predict(X_test)
-
-# Saves model to a .pkl file
-pickle.dump(model, open('model.pkl',"wb"))
-
-# Calculate the accuracy of the classifier
-accuracy = accuracy_score(y_test, y_pred)
-print("Accuracy:", accuracy)
-
-class_names = label_encoder.classes_
-
-confusion_matrix = confusion_matrix(y_test, y_pred)
-print("Confusion Matrix:", confusion_matrix)
-
-for i in range(len(class_names)):
-    print(f"Label: {class_names[i]}")
-    for j in range(len(class_names)):
-        print(f"Predicted: {class_names[j]}, Count:{confusion_matrix[i, j]}")
-
-feature_names = [f"feature_{i}" for i in range(X_train.shape[1])]
-class_names = np.unique(y_train)
-
-dot_data = export_graphviz(
-    tree_estimator,
-    feature_names=feature_names,
-    class_names=class_names,
-    filled=True,
-    rounded=True)
-
-graph = Source(dot_data)
-graph.render("decision_tree")
-
-# Visualize the test images
-num_images = 5  # Number of images to visualize
-fig, axes = plt.subplots(1, num_images, figsize=(15, 5))
-
-for i in range(num_images):
-    image_show = X_test[i].reshape(50, 50, 3)
-    label = y_test[i]
-    pred_label = y_pred[i]
-    
-    # Display the image
-    axes[i].imshow(image_show[:, :, :3])  # Display only RGB bands, excluding NIR
-    axes[i].set_title(f"True: {label}\nPredicted: {pred_label}")
-    axes[i].axis('off')
-
-plt.tight_layout()
-plt.show()
-
-classification_report=classification_report(y_test, y_pred)
-print(classification_report)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the Random Forest Classifier')
+    parser.add_argument('--visualize', action='store_true', help='plot sample training and test images')
+    parser.add_argument('--classifier', default='random_forest',
+                        choices=['random_forest', 'extra_trees', 'hist_gradient_boosting'],
+                        help='tree ensemble to train')
+    args = parser.parse_args()
+
+    image_path, label_path = get_training_data()
+
+    # Build the feature matrix on disk: originals, then flipped, then rotated images
+    features_path = 'features.dat'
+    images = load_and_augment(image_path, features_path)
+
+    # Parse each xml file once, the augmented images share the labels of the originals
+    labels = [extract_classification(label) for label in label_path]
+    labels = np.array(labels * 3)
+
+    # Visualize 5 sample images
+    if args.visualize:
+        num_samples = 5
+        fig, axes = plt.subplots(1, num_samples, figsize=(15, 5))
+
+        # Pixel values are already float in [0, 1], clip all the samples at once
+        image_show_rgb = np.clip(images[:num_samples].reshape(-1, 50, 50, 3), 0, 1)
+
+        for i in range(num_samples):
+            # Display the image
+            axes[i].imshow(image_show_rgb[i])  # Display RGB image
+            axes[i].set_title(f"Label: {labels[i]}")
+            axes[i].axis('off')
+
+        plt.tight_layout()
+        plt.show()
+
+    print(images.shape)
+    print(labels.shape)
+
+    # Split the data into training and testing sets
+    X_train, X_test, y_train, y_test = train_test_split(images, labels, test_size=0.2, random_state=60)
+
+    # Encode the labels
+    label_encoder = LabelEncoder()
+    y_train_encoded = label_encoder.fit_transform(y_train)
+    y_test_encoded = label_encoder.transform(y_test)
+
+    if args.classifier == 'extra_trees':
+        # Extra Trees draw random split thresholds instead of sorting each candidate feature
+        model = ExtraTreesClassifier(n_estimators=130, n_jobs=-1, random_state=60)
+    elif args.classifier == 'hist_gradient_boosting':
+        # Bins every feature into at most 255 uint8 levels once, before boosting
+        model = HistGradientBoostingClassifier(max_iter=200, max_bins=255, early_stopping=True, random_state=60)
+    else:
+        # Initiates the Random Forest classifier, building trees on every core (also used by predict).
+        # Each split only searches sqrt(n_features) pixels and the tree depth is capped
+        model = RandomForestClassifier(
+            n_estimators=130,
+            max_features='sqrt',
+            max_depth=20,
+            min_samples_leaf=2,
+            n_jobs=-1,
+            random_state=60)
+
+    # Train the classifier on the integer encoded labels
+    model = model.fit(X_train, y_train_encoded)
+
+    # Predict the labels for the test set and decode them back to class names
+    y_pred_encoded = model.predict(X_test)
+    y_pred = label_encoder.inverse_transform(y_pred_encoded)
+
+    # Saves model (compressed) and label encoder to .joblib files
+    joblib.dump(model, 'model.joblib', compress=3)
+    joblib.dump(label_encoder, 'label_encoder.joblib')
+
+    # Calculate the accuracy of the classifier
+    accuracy = accuracy_score(y_test_encoded, y_pred_encoded)
+    print("Accuracy:", accuracy)
+
+    class_names = label_encoder.classes_
+
+    confusion_matrix = confusion_matrix(y_test, y_pred)
+    print("Confusion Matrix:", confusion_matrix)
+
+    for i in range(len(class_names)):
+        print(f"Label: {class_names[i]}")
+        for j in range(len(class_names)):
+            print(f"Predicted: {class_names[j]}, Count:{confusion_matrix[i, j]}")
+
+    # Exports the first tree of the forest, gradient boosting has no estimators_ to export
+    if hasattr(model, 'estimators_'):
+        tree_estimator = model.estimators_[0]
+
+        feature_names = [f"feature_{i}" for i in range(X_train.shape[1])]
+        class_names = label_encoder.classes_
+
+        dot_data = export_graphviz(
+            tree_estimator,
+            feature_names=feature_names,
+            class_names=class_names,
+            filled=True,
+            rounded=True)
+
+        graph = Source(dot_data)
+        graph.render("decision_tree")
+
+    # Visualize the test images
+    if args.visualize:
+        num_images = 5  # Number of images to visualize
+        fig, axes = plt.subplots(1, num_images, figsize=(15, 5))
+
+        for i in range(num_images):
+            image_show = X_test[i].reshape(50, 50, 3)
+            label = y_test[i]
+            pred_label = y_pred[i]
+
+            # Display the image
+            axes[i].imshow(image_show[:, :, :3])  # Display only RGB bands, excluding NIR
+            axes[i].set_title(f"True: {label}\nPredicted: {pred_label}")
+            axes[i].axis('off')
+
+        plt.tight_layout()
+        plt.show()
+
+    classification_report=classification_report(y_test, y_pred)
+    print(classification_report)
@@ -2,11 +2,12 @@
 import geopandas as gpd
 import numpy as np
 import rasterio
-import pickle
+import joblib
 from matplotlib import pyplot as plt
 from rasterio.mask import mask
 from rasterio.plot import show
-from skimage.transform import resize
+from skimage.util import img_as_float32
+import cv2
 
 def prepare_roof(geometry, opentif):
     """
@@ -30,20 +31,14 @@ def prepare_roof(geometry, opentif):
     blue = masked_img[:, :, 2]
     alpha = masked_img[:, :, 3]
 
-    red_masked = red[alpha != 0]
-    green_masked = green[alpha != 0]
-    blue_masked = blue[alpha != 0]
-
-    red_masked = resize(red_masked, (red.shape[0], red.shape[1]))
-    green_masked = resize(green_masked, (red.shape[0], red.shape[1]))
-    blue_masked = resize(blue_masked, (red.shape[0], red.shape[1]))
+    # Zero the pixels outside the alpha band and scale the values to [0, 1]
+    red_masked = img_as_float32(np.where(alpha != 0, red, 0))
+    green_masked = img_as_float32(np.where(alpha != 0, green, 0))
+    blue_masked = img_as_float32(np.where(alpha != 0, blue, 0))
 
     rgb = np.dstack((red_masked, green_masked, blue_masked))
 
-    #plt.imshow(rgb)
-    #plt.show()
-
-    resized_tiff = resize(rgb, (50, 50, 3))
+    resized_tiff = cv2.resize(rgb, (50, 50), interpolation=cv2.INTER_LINEAR)
     resized_tiff = resized_tiff.flatten()
     resized_tiff = resized_tiff.reshape(1, -1)
     return resized_tiff
@@ -62,8 +57,12 @@ print(shapefile.crs)
 shapefile = shapefile.to_crs(opentif.crs)
 
 # Loads the pre-trained model
-modelpath = 'model.pkl'
-loaded_model = pickle.load(open(modelpath, "rb"))
+modelpath = 'model.joblib'
+loaded_model = joblib.load(modelpath)
+
+# Loads the label encoder used to turn predictions back into class names
+encoderpath = 'label_encoder.joblib'
+label_encoder = joblib.load(encoderpath)
 
 # Create a new attribute column for predictions
 shapefile['predictions'] = None
@@ -78,7 +77,7 @@ for index, row in shapefile.iterrows():
         print(geometry)
         resized_tiff=prepare_roof(geometry, opentif) # Prepares the tiff for classification
         predictions = loaded_model.predict(resized_tiff) # The Prepares tiff is sent for classification
-        prediction = predictions[0] # Extracts prediction label
+        prediction = label_encoder.inverse_transform(predictions)[0] # Extracts prediction label
         shapefile.at[index, 'predictions'] = prediction  # Assign the prediction to the new attribute
         print(count, prediction)
         count += 1